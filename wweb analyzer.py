@@ -1,6 +1,14 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import polars as pl
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import io
+import xlsxwriter
+
+# Copy-on-write lets filtered frames be passed around as views without .copy()
+pd.options.mode.copy_on_write = True
 
 # Page configuration
 st.set_page_config(
@@ -43,11 +51,171 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+# File loading
+@st.cache_data(show_spinner=False, max_entries=8)
+def load_df(file_bytes, name):
+    # Arrow-backed columns keep strings in contiguous buffers and group faster
+    if name.endswith('.csv'):
+        # The pyarrow engine parses on multiple threads
+        df = pd.read_csv(io.BytesIO(file_bytes), engine='pyarrow', dtype_backend='pyarrow')
+    elif name.endswith('.xls'):
+        df = pd.read_excel(io.BytesIO(file_bytes), engine='xlrd', dtype_backend='pyarrow')
+    else:
+        df = pd.read_excel(io.BytesIO(file_bytes), engine='calamine', dtype_backend='pyarrow')
+    
+    # Clean column names - remove leading/trailing spaces (headers may be numeric cells)
+    df.columns = df.columns.astype(str).str.strip()
+    return df
+
+# Amount parsing
+def to_amount(values):
+    # Only text columns need parsing; numeric ones (e.g. Arrow doubles) pass straight through
+    if not pd.api.types.is_numeric_dtype(values):
+        # (dtype_backend keeps unparseable entries as nulls, not NaN, so fillna catches them)
+        values = pd.to_numeric(values, errors='coerce', dtype_backend='pyarrow')
+    return values.fillna(0)
+
+# Analysis function
+# (cached on the upload bytes and region rather than a DataFrame argument: Streamlit
+# hashes large frames from a row sample, so an edited file could hit a stale entry)
+@st.cache_data(show_spinner=False, max_entries=32)
+def analyze_data(file_bytes, name, region):
+    df = load_df(file_bytes, name)
+    
+    # Apply region filter
+    if region != 'All Regions':
+        df = df[df['REGION'] == region]
+    
+    # Clean data (BENEFICIARIES is cast to strings first: Arrow reads numeric IDs as
+    # int64 and all-blank columns as null, neither of which can hold 'Unknown'/'TOTAL';
+    # GENCO/ERD keeps its own dtype so numeric codes still sort numerically)
+    df_clean = df.dropna(subset=['GENCO/ERD', 'FUND', 'AMOUNT']).assign(
+        FUND=lambda d: d['FUND'].astype('string[pyarrow]'),
+        BENEFICIARIES=lambda d: d['BENEFICIARIES'].astype('string[pyarrow]').fillna('Unknown'),
+        AMOUNT=lambda d: to_amount(d['AMOUNT'])
+    )
+    
+    if len(df_clean) == 0:
+        return None, None
+    
+    # Pivot table (aggregated in Polars, which groups multi-threaded outside the GIL)
+    pivot = (
+        pl.from_pandas(df_clean[['GENCO/ERD', 'BENEFICIARIES', 'FUND', 'AMOUNT']])
+        .group_by(['GENCO/ERD', 'BENEFICIARIES', 'FUND'])
+        .agg(pl.col('AMOUNT').sum())
+        .pivot(on='FUND', index=['GENCO/ERD', 'BENEFICIARIES'], values='AMOUNT', aggregate_function=None)
+        .fill_null(0)
+        .sort(['GENCO/ERD', 'BENEFICIARIES'])
+        .to_pandas()
+        .set_index(['GENCO/ERD', 'BENEFICIARIES'])
+    )
+    
+    # Ensure columns exist
+    target_cols = ['EF', 'DLF', 'RWMHEEF']
+    pivot = pivot.reindex(columns=target_cols, fill_value=0.0)
+    
+    # Summary statistics (taken here so the caller doesn't re-scan the result)
+    stats = {
+        'total_rows': len(pivot),
+        'unique_gencos': df_clean['GENCO/ERD'].nunique(),
+        'unique_beneficiaries': df_clean['BENEFICIARIES'].nunique(),
+        'total_amount': pivot.to_numpy().sum()
+    }
+    
+    # Append each GENCO's subtotal right after its rows (pivot is already sorted,
+    # so this builds the output in order without a sort); the values are stacked
+    # as plain arrays and the DataFrame is built once at the end
+    values_arrays = []
+    keys = []
+    for genco, group in pivot.groupby(level='GENCO/ERD'):
+        values = group.to_numpy()
+        values_arrays.append(values)
+        values_arrays.append(values.sum(axis=0, keepdims=True))
+        keys.extend(group.index)
+        keys.append((genco, 'TOTAL'))
+    
+    combined = pd.DataFrame(
+        np.concatenate(values_arrays, axis=0),
+        index=pd.MultiIndex.from_tuples(keys, names=pivot.index.names),
+        columns=target_cols
+    ).reset_index()
+    
+    return combined, stats
+
+# Excel export (not cached: it only runs on click, and a DataFrame cache key
+# is hashed from a row sample for large results, which could serve a stale file)
+def _build_xlsx(df):
+    # constant_memory flushes row by row, so rows must be written in order;
+    # pandas' to_excel writes column by column and would lose data
+    buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(buffer, {'constant_memory': True, 'strings_to_numbers': False})
+    worksheet = workbook.add_worksheet('Analysis')
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center'})
+    worksheet.write_row(0, 0, df.columns.tolist(), header_format)
+    for row_idx, row in enumerate(df.itertuples(index=False), start=1):
+        worksheet.write_row(row_idx, 0, row)
+    workbook.close()
+    return buffer.getvalue()
+
+# CSV export (not cached, for the same reason as the Excel export)
+def _build_csv(df):
+    # Arrow's multithreaded C++ writer instead of to_csv's per-row formatting
+    buffer = io.BytesIO()
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), buffer)
+    return buffer.getvalue()
+
+# Results table (a fragment, so its own reruns skip the rest of the page)
+@st.fragment
+def show_results(df_result):
+    # Highlight subtotals (one vectorized call for the whole frame)
+    def highlight_subtotals(df):
+        is_total = df['BENEFICIARIES'].to_numpy()[:, None] == 'TOTAL'
+        css = np.where(is_total, 'background-color: #dbeafe; font-weight: bold', '')
+        return pd.DataFrame(np.broadcast_to(css, df.shape), index=df.index, columns=df.columns)
+    
+    # Format amounts in the styler so the underlying columns stay numeric
+    styled_df = df_result.style.apply(highlight_subtotals, axis=None).format({
+        'EF': '₱{:,.2f}',
+        'DLF': '₱{:,.2f}',
+        'RWMHEEF': '₱{:,.2f}'
+    })
+    
+    st.dataframe(
+        styled_df,
+        width='stretch',
+        height=400
+    )
+
+# Download buttons (a fragment, so a click reruns only this block)
+@st.fragment
+def show_downloads(df_result):
+    col1, col2, col3 = st.columns([1, 1, 2])
+    
+    with col1:
+        # Excel download (built only when clicked)
+        st.download_button(
+            label="📥 Download Excel",
+            data=lambda: _build_xlsx(df_result),
+            file_name="fund_analysis.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            width='stretch'
+        )
+    
+    with col2:
+        # CSV download (built only when clicked)
+        st.download_button(
+            label="📥 Download CSV",
+            data=lambda: _build_csv(df_result),
+            file_name="fund_analysis.csv",
+            mime="text/csv",
+            width='stretch'
+        )
+
 # Initialize session state
-if 'df_raw' not in st.session_state:
-    st.session_state.df_raw = None
-if 'df_final' not in st.session_state:
-    st.session_state.df_final = None
+if 'regions' not in st.session_state:
+    st.session_state.regions = None
+if 'has_region' not in st.session_state:
+    st.session_state.has_region = False
 
 # Header
 st.title("📊 Genco & Beneficiary Fund Analyzer")
@@ -71,14 +239,11 @@ with st.sidebar:
     st.markdown("---")
     
     # Region filter (will be populated after file upload)
-    if st.session_state.df_raw is not None:
-        if 'REGION' in st.session_state.df_raw.columns:
-            regions = ['All Regions'] + sorted(
-                st.session_state.df_raw['REGION'].dropna().unique().tolist()
-            )
+    if st.session_state.regions is not None:
+        if st.session_state.has_region:
             selected_region = st.selectbox(
                 "🔍 Filter by Region",
-                regions,
+                st.session_state.regions,
                 key='region_filter'
             )
         else:
@@ -112,180 +277,82 @@ else:
     # Process uploaded file
     try:
         # Read file
-        if uploaded_file.name.endswith('.csv'):
-            df = pd.read_csv(uploaded_file)
-        else:
-            df = pd.read_excel(uploaded_file, engine='openpyxl')
-        
-        # Clean column names - remove leading/trailing spaces
-        df.columns = df.columns.str.strip()
-        
-        # Validate columns
-        required_columns = ['GENCO/ERD', 'BENEFICIARIES', 'FUND', 'AMOUNT']
-        missing_cols = [col for col in required_columns if col not in df.columns]
-        
-        if missing_cols:
-            st.error(f"❌ Missing required columns: {', '.join(missing_cols)}")
-            st.info(f"**Found columns:** {', '.join(df.columns.tolist())}")
-            st.stop()
-        
-        # Store raw data
-        st.session_state.df_raw = df.copy()
-        
-        # Apply region filter
-        if 'region_filter' in st.session_state and st.session_state.region_filter != 'All Regions':
-            df_filtered = df[df['REGION'] == st.session_state.region_filter].copy()
-        else:
-            df_filtered = df.copy()
-        
-        # Analysis function
-        def analyze_data(df):
-            # Clean data
-            df_clean = df.dropna(subset=['GENCO/ERD', 'FUND', 'AMOUNT']).copy()
-            df_clean['BENEFICIARIES'] = df_clean['BENEFICIARIES'].fillna('Unknown')
-            df_clean['AMOUNT'] = pd.to_numeric(df_clean['AMOUNT'], errors='coerce').fillna(0)
-            
-            if len(df_clean) == 0:
-                return None
-            
-            # Pivot table
-            pivot = df_clean.pivot_table(
-                index=['GENCO/ERD', 'BENEFICIARIES'],
-                columns='FUND',
-                values='AMOUNT',
-                aggfunc='sum',
-                fill_value=0
-            )
-            
-            # Ensure columns exist
-            target_cols = ['EF', 'DLF', 'RWMHEEF']
-            for col in target_cols:
-                if col not in pivot.columns:
-                    pivot[col] = 0.0
-            
-            pivot = pivot[target_cols]
-            
-            # Create main df
-            main_df = pivot.reset_index()
-            
-            # Calculate subtotals
-            subtotals = main_df.groupby('GENCO/ERD')[target_cols].sum().reset_index()
-            subtotals['BENEFICIARIES'] = 'TOTAL'
-            
-            # Combine
-            main_df['sort_helper'] = 0
-            subtotals['sort_helper'] = 1
-            
-            combined = pd.concat([main_df, subtotals], ignore_index=True)
-            combined = combined.sort_values(['GENCO/ERD', 'sort_helper', 'BENEFICIARIES'])
-            
-            return combined.drop(columns='sort_helper')
-        
-        # Perform analysis
-        df_result = analyze_data(df_filtered)
-        
-        if df_result is None or len(df_result) == 0:
-            st.warning("⚠️ No valid data to analyze after filtering")
-            st.stop()
-        
-        st.session_state.df_final = df_result
-        
-        # Calculate statistics
-        data_rows = df_result[df_result['BENEFICIARIES'] != 'TOTAL']
-        total_rows = len(data_rows)
-        unique_gencos = data_rows['GENCO/ERD'].nunique()
-        unique_beneficiaries = data_rows['BENEFICIARIES'].nunique()
-        total_amount = data_rows[['EF', 'DLF', 'RWMHEEF']].sum().sum()
-        
-        # Display metrics
-        st.markdown("### 📈 Summary Statistics")
-        col1, col2, col3, col4 = st.columns(4)
-        
-        with col1:
-            st.metric(
-                label="📄 Total Rows",
-                value=f"{total_rows:,}"
-            )
-        
-        with col2:
-            st.metric(
-                label="🏢 Unique Gencos",
-                value=f"{unique_gencos:,}"
-            )
-        
-        with col3:
-            st.metric(
-                label="👥 Beneficiaries",
-                value=f"{unique_beneficiaries:,}"
-            )
-        
-        with col4:
-            st.metric(
-                label="💰 Total Amount",
-                value=f"₱{total_amount:,.2f}"
-            )
-        
-        st.markdown("---")
-        
-        # Display data
-        st.markdown("### 📋 Analysis Results")
-        
-        # Format display dataframe
-        display_df = df_result.copy()
-        display_df['EF'] = display_df['EF'].apply(lambda x: f"₱{x:,.2f}")
-        display_df['DLF'] = display_df['DLF'].apply(lambda x: f"₱{x:,.2f}")
-        display_df['RWMHEEF'] = display_df['RWMHEEF'].apply(lambda x: f"₱{x:,.2f}")
-        
-        # Highlight subtotals
-        def highlight_subtotals(row):
-            if row['BENEFICIARIES'] == 'TOTAL':
-                return ['background-color: #dbeafe; font-weight: bold'] * len(row)
-            return [''] * len(row)
-        
-        styled_df = display_df.style.apply(highlight_subtotals, axis=1)
-        
-        st.dataframe(
-            styled_df,
-            use_container_width=True,
-            height=400
-        )
-        
-        # Download section
-        st.markdown("---")
-        st.markdown("### 💾 Download Results")
-        
-        col1, col2, col3 = st.columns([1, 1, 2])
-        
-        with col1:
-            # Excel download
-            buffer = io.BytesIO()
-            with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                df_result.to_excel(writer, sheet_name='Analysis', index=False)
-            
-            st.download_button(
-                label="📥 Download Excel",
-                data=buffer.getvalue(),
-                file_name="fund_analysis.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                use_container_width=True
-            )
-        
-        with col2:
-            # CSV download
-            csv = df_result.to_csv(index=False).encode('utf-8')
-            st.download_button(
-                label="📥 Download CSV",
-                data=csv,
-                file_name="fund_analysis.csv",
-                mime="text/csv",
-                use_container_width=True
-            )
-        
-        st.success("✅ Analysis complete! You can download the results above.")
-        
+        df = load_df(uploaded_file.getvalue(), uploaded_file.name)
     except Exception as e:
         st.error(f"❌ Error processing file: {str(e)}")
         st.info("Please check your file format and try again.")
+        st.stop()
+    
+    # Validate columns
+    required_columns = ['GENCO/ERD', 'BENEFICIARIES', 'FUND', 'AMOUNT']
+    missing_cols = [col for col in required_columns if col not in df.columns]
+    
+    if missing_cols:
+        st.error(f"❌ Missing required columns: {', '.join(missing_cols)}")
+        st.info(f"**Found columns:** {', '.join(df.columns.tolist())}")
+        st.stop()
+    
+    # Store region options for the sidebar filter
+    st.session_state.has_region = 'REGION' in df.columns
+    if st.session_state.has_region:
+        st.session_state.regions = ['All Regions'] + sorted(df['REGION'].dropna().unique().tolist())
+    else:
+        st.session_state.regions = ['All Regions']
+    
+    # Perform analysis for the selected region (a filter left over from a previous
+    # upload is ignored when this file has no REGION column)
+    if st.session_state.has_region:
+        region = st.session_state.get('region_filter', 'All Regions')
+    else:
+        region = 'All Regions'
+    df_result, stats = analyze_data(uploaded_file.getvalue(), uploaded_file.name, region)
+    
+    if df_result is None or len(df_result) == 0:
+        st.warning("⚠️ No valid data to analyze after filtering")
+        st.stop()
+    
+    # Display metrics
+    st.markdown("### 📈 Summary Statistics")
+    col1, col2, col3, col4 = st.columns(4)
+    
+    with col1:
+        st.metric(
+            label="📄 Total Rows",
+            value=f"{stats['total_rows']:,}"
+        )
+    
+    with col2:
+        st.metric(
+            label="🏢 Unique Gencos",
+            value=f"{stats['unique_gencos']:,}"
+        )
+    
+    with col3:
+        st.metric(
+            label="👥 Beneficiaries",
+            value=f"{stats['unique_beneficiaries']:,}"
+        )
+    
+    with col4:
+        st.metric(
+            label="💰 Total Amount",
+            value=f"₱{stats['total_amount']:,.2f}"
+        )
+    
+    st.markdown("---")
+    
+    # Display data
+    st.markdown("### 📋 Analysis Results")
+    
+    show_results(df_result)
+    
+    # Download section
+    st.markdown("---")
+    st.markdown("### 💾 Download Results")
+    
+    show_downloads(df_result)
+    
+    st.success("✅ Analysis complete! You can download the results above.")
 
 # Footer
 st.markdown("---")